@@ -25,13 +25,14 @@ class CNNInception(TFModel):
 
     def _build_network(self, images):
         with slim.arg_scope(inception_v2.inception_v2_arg_scope()):
-            net, end_points = inception_v2.inception_v2_base(images, final_endpoint='Mixed_3c')
+            net, end_points = inception_v2.inception_v2_base(images, final_endpoint='Mixed_3c',
+                                                           scope='InceptionV2')
 
         net = slim.avg_pool2d(net, [7, 7], stride=1, scope="MaxPool_0a_7x7")
         net = slim.dropout(net,
                            0.8, scope='Dropout_0b')
         net = slim.conv2d(net, 1, [1, 1], activation_fn=None,
-                          normalizer_fn=None)  # , scope='Conv2d_0c_1x1'
+                          normalizer_fn=None, scope='Conv')
 
         net = tf.pad(net, [[0, 0], [3, 3], [3, 3], [0, 0]])
 
@@ -1,4 +1,5 @@
-from tensorflow.python.ops import rnn_cell_impl, array_ops, math_ops, nn_ops, init_ops
+from tensorflow.python.layers import convolutional
+from tensorflow.python.ops import rnn, rnn_cell_impl, array_ops, math_ops, nn_ops, init_ops
 from tensorflow.python.ops import variable_scope as vs
 
 # from https://github.com/tensorflow/tensorflow/pull/8891
@@ -16,6 +17,9 @@ class ConvLSTMCell(rnn_cell_impl.RNNCell):
                skip_connection=False,
                forget_bias=1.0,
                initializers=None,
+               project_inputs=False,
+               data_format="channels_last",
+               reuse=None,
                name="conv_lstm_cell"):
     """Construct ConvLSTMCell.
     Args:
@@ -26,126 +30,212 @@ class ConvLSTMCell(rnn_cell_impl.RNNCell):
       skip_connection: If set to `True`, concatenate the input to the
       output of the conv LSTM. Default: `False`.
       forget_bias: Forget bias.
+      project_inputs: If set to `True`, the cell takes input sequences that
+        were convolved ahead of time with `project_inputs()` (as done by
+        `dynamic_conv_lstm`) and only convolves the hidden state per step.
+      data_format: "channels_last" or "channels_first"; layout of the inputs,
+        outputs and state. `input_shape` is given in the same layout.
+        cuDNN convolutions run natively in channels_first.
+      reuse: (optional) Python boolean describing whether to reuse variables
+        in an existing scope, e.g. to run a second copy of a network.
       name: Name of the module.
     Raises:
       ValueError: If `skip_connection` is `True` and stride is different from 1
         or if `input_shape` is incompatible with `conv_ndims`.
+      ValueError: If `data_format` is not one of the two accepted values.
+      ValueError: If both `project_inputs` and `skip_connection` are set,
+        since the cell no longer sees the raw inputs.
     """
-    super(ConvLSTMCell, self).__init__(name=name)
+    super(ConvLSTMCell, self).__init__(_reuse=reuse, name=name)
 
     conv_ndims = len(kernel_shape)
 
     self._conv_ndims = conv_ndims
-    self._input_shape = input_shape
+    self._input_shape = list(input_shape)
     self._output_channels = output_channels
-    self._kernel_shape = kernel_shape
+    self._kernel_shape = list(kernel_shape)
     self._use_bias = use_bias
     self._forget_bias = forget_bias
     self._skip_connection = skip_connection
+    if project_inputs and skip_connection:
+      raise ValueError("Cannot project inputs of a cell with skip_connection")
+    self._project_inputs = project_inputs
+
+    if data_format not in ("channels_last", "channels_first"):
+      raise ValueError("Unknown data_format: %s" % data_format)
+    self._data_format = data_format
+    if data_format == "channels_first":
+      self._channel_axis = 1
+      self._spatial_shape = self._input_shape[1:]
+      self._input_channels = self._input_shape[0]
+    else:
+      self._channel_axis = -1
+      self._spatial_shape = self._input_shape[:-1]
+      self._input_channels = self._input_shape[-1]
 
     self._total_output_channels = output_channels
     if self._skip_connection:
-      self._total_output_channels += self._input_shape[-1]
+      self._total_output_channels += self._input_channels
+
+  def _shape(self, channels):
+    """Shape of a `channels` deep tensor in this cell's layout, excluding
+    the batch size."""
+    if self._data_format == "channels_first":
+      return [channels] + self._spatial_shape
+    return self._spatial_shape + [channels]
 
   @property
   def output_size(self):
-    return self._input_shape[:-1] + [self._total_output_channels]
+    return self._shape(self._total_output_channels)
 
   @property
   def state_size(self):
-    return self._input_shape[:-1] + [self._output_channels]
+    return self._shape(self._output_channels)
 
   def zero_state(self, batch_size, dtype):
-    shape = ([batch_size]
-            + self._input_shape[:-1]
-            + [self._total_output_channels])
+    shape = [batch_size] + self._shape(self._total_output_channels)
     zero_cell = array_ops.zeros(shape, dtype=dtype)
     zero_hidden = array_ops.zeros(shape, dtype=dtype)
     zero_state = rnn_cell_impl.LSTMStateTuple(zero_cell, zero_hidden)
     return zero_state
 
+  def project_inputs(self, inputs):
+    """Convolve a whole input sequence with the input-to-state kernel.
+    The input part of the gates does not depend on the state, so it is
+    computed for all timesteps at once; afterwards the cell takes these
+    projected gates as its inputs and only convolves the hidden state.
+    Args:
+      inputs: Tensor of shape [batch, time] + input_shape.
+    Returns:
+      Tensor of shape [batch, time] + input_shape, with the channel dimension
+      replaced by 4*output_channels.
+    Raises:
+      ValueError: If the cell wasn't constructed with `project_inputs`.
+    """
+    if not self._project_inputs:
+      raise ValueError("Cell was not constructed with project_inputs=True")
+
+    conv = {1: convolutional.conv1d,
+            2: convolutional.conv2d,
+            3: convolutional.conv3d}[self._conv_ndims]
+
+    # fold time into the batch dimension so one conv covers the whole sequence
+    merged = array_ops.reshape(inputs, [-1] + self._input_shape)
+    projected = conv(merged,
+                     filters=4*self._output_channels,
+                     kernel_size=self._kernel_shape,
+                     padding="same",
+                     data_format=self._data_format,
+                     use_bias=False,
+                     name="input_projection")
+    projected_shape = self._shape(4*self._output_channels)
+    projected = array_ops.reshape(
+        projected,
+        array_ops.concat([array_ops.shape(inputs)[:2], projected_shape], 0))
+    projected.set_shape(inputs.get_shape()[:2].concatenate(projected_shape))
+    return projected
+
+  def build(self, inputs_shape):
+    if len(self._input_shape) != self._conv_ndims + 1:
+      raise ValueError("Conv LSTM expects input_shape of rank %d: %s"
+                       % (self._conv_ndims + 1, str(self._input_shape)))
+
+    # pick the conv operation once instead of on every step
+    channels_first = self._data_format == "channels_first"
+    if   self._conv_ndims == 1:
+      self._conv_op = nn_ops.conv1d
+      self._strides = 1
+      self._conv_format = "NCW" if channels_first else "NWC"
+    elif self._conv_ndims == 2:
+      self._conv_op = nn_ops.conv2d
+      self._strides = 4*[1]
+      self._conv_format = "NCHW" if channels_first else "NHWC"
+    elif self._conv_ndims == 3:
+      self._conv_op = nn_ops.conv3d
+      self._strides = 5*[1]
+      self._conv_format = "NCDHW" if channels_first else "NDHWC"
+    self._bias_format = "NCHW" if channels_first else "NHWC"
+
+    # projected inputs already hold the input contribution to the gates, so
+    # only the hidden state is convolved with the cell's kernel
+    depth = self._total_output_channels
+    if not self._project_inputs:
+      depth += self._input_channels
+
+    self._kernel = self.add_weight(
+        "kernel",
+        self._kernel_shape + [depth, 4*self._output_channels])
+    if self._use_bias:
+      # start the forget gate block of [i|j|f|o] at forget_bias, so call()
+      # doesn't need a separate add
+      channels = self._output_channels
+      bias_start = [0.]*2*channels + [self._forget_bias]*channels + [0.]*channels
+      self._bias = self.add_weight(
+          "biases",
+          [4*channels],
+          initializer=init_ops.constant_initializer(bias_start))
+    else:
+      self._bias = None
+
+    self.built = True
+
   def call(self, inputs, state, scope=None):
     cell, hidden = state
-    new_hidden = _conv([inputs, hidden],
-                       self._kernel_shape,
-                       4*self._output_channels,
-                       self._use_bias)
-    gates = array_ops.split(value=new_hidden,
-                            num_or_size_splits=4,
-                            axis=self._conv_ndims+1)
-
-    input_gate, new_input, forget_gate, output_gate = gates
-    new_cell = math_ops.sigmoid(forget_gate + self._forget_bias) * cell
+    if self._project_inputs:
+      conv_input = hidden
+    else:
+      conv_input = array_ops.concat([inputs, hidden], axis=self._channel_axis)
+    new_hidden = self._conv_op(conv_input,
+                               self._kernel,
+                               self._strides,
+                               padding="SAME",
+                               data_format=self._conv_format)
+    if self._use_bias:
+      # BiasAdd right after the conv can be fused into it by grappler's remapper
+      new_hidden = nn_ops.bias_add(new_hidden,
+                                   self._bias,
+                                   data_format=self._bias_format)
+    if self._project_inputs:
+      new_hidden += inputs
+    # view the [i|j|f|o] channel blocks as a separate axis so the gates
+    # unpack as views (fused away under XLA) instead of a split
+    if self._data_format == "channels_first":
+      gates = array_ops.reshape(new_hidden,
+                                [-1, 4, self._output_channels]
+                                + self._spatial_shape)
+      gate_axis = 1
+    else:
+      gates = array_ops.reshape(new_hidden,
+                                [-1] + self._spatial_shape
+                                + [4, self._output_channels])
+      gate_axis = -2
+
+    input_gate, new_input, forget_gate, output_gate = array_ops.unstack(
+        gates, axis=gate_axis)
+    if self._use_bias:
+      # forget_bias is folded into the bias initializer
+      new_cell = math_ops.sigmoid(forget_gate) * cell
+    else:
+      new_cell = math_ops.sigmoid(forget_gate + self._forget_bias) * cell
     new_cell += math_ops.sigmoid(input_gate) * math_ops.tanh(new_input)
     output = math_ops.tanh(new_cell) * math_ops.sigmoid(output_gate)
 
     if self._skip_connection:
-      output = array_ops.concat([output, inputs], axis=-1)
+      output = array_ops.concat([output, inputs], axis=self._channel_axis)
     new_state = rnn_cell_impl.LSTMStateTuple(new_cell, output)
     return output, new_state
 
-def _conv(args,
-          filter_size,
-          num_features,
-          bias,
-          bias_start=0.0):
-  """convolution:
+def dynamic_conv_lstm(cell, inputs, scope=None, **kwargs):
+  """Run `cell` over `inputs` like `dynamic_rnn`, with the input convolution
+  hoisted out of the time loop.
   Args:
-    args: a Tensor or a list of Tensors of dimension 3D, 4D or 5D,
-    batch x n, Tensors.
-    filter_size: int tuple of filter height and width.
-    num_features: int, number of features.
-    bias_start: starting value to initialize the bias; 0 by default.
+    cell: ConvLSTMCell constructed with `project_inputs=True`.
+    inputs: Tensor of shape [batch, time] + input_shape.
+    scope: VariableScope for the created subgraph; defaults to "rnn".
+    **kwargs: Passed on to `dynamic_rnn`.
   Returns:
-    A 3D, 4D, or 5D Tensor with shape [batch ... num_features]
-  Raises:
-    ValueError: if some of the arguments has unspecified or wrong shape.
+    A pair (outputs, state) as returned by `dynamic_rnn`.
   """
-
-  # Calculate the total size of arguments on dimension 1.
-  total_arg_size_depth = 0
-  shapes = [a.get_shape().as_list() for a in args]
-  shape_length = len(shapes[0])
-  for shape in shapes:
-    if len(shape) not in [3,4,5]:
-      raise ValueError("Conv Linear expects 3D, 4D or 5D arguments: %s" % str(shapes))
-    if len(shape) != len(shapes[0]):
-      raise ValueError("Conv Linear expects all args to be of same Dimensiton: %s" % str(shapes))
-    else:
-      total_arg_size_depth += shape[-1]
-  dtype = [a.dtype for a in args][0]
-
-  # determine correct conv operation
-  if   shape_length == 3:
-    conv_op = nn_ops.conv1d
-    strides = 1
-  elif shape_length == 4:
-    conv_op = nn_ops.conv2d
-    strides = shape_length*[1]
-  elif shape_length == 5:
-    conv_op = nn_ops.conv3d
-    strides = shape_length*[1]
-
-  # Now the computation.
-  kernel = vs.get_variable(
-      "kernel",
-      filter_size + [total_arg_size_depth, num_features],
-      dtype=dtype)
-  if len(args) == 1:
-    res = conv_op(args[0],
-                  kernel,
-                  strides,
-                  padding="SAME")
-  else:
-   res = conv_op(array_ops.concat(axis=shape_length-1, values=args),
-                 kernel,
-                 strides,
-                 padding="SAME")
-  if not bias:
-    return res
-  bias_term = vs.get_variable(
-      "biases", [num_features],
-      dtype=dtype,
-      initializer=init_ops.constant_initializer(
-          bias_start, dtype=dtype))
-  return res + bias_term
\ No newline at end of file
+  with vs.variable_scope(scope or "rnn") as varscope:
+    projected = cell.project_inputs(inputs)
+    return rnn.dynamic_rnn(cell, projected, scope=varscope, **kwargs)
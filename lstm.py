@@ -1,13 +1,16 @@
 import tensorflow as tf
 
 import misc
-from convolutional_lstm import ConvLSTMCell
+from convolutional_lstm import ConvLSTMCell, dynamic_conv_lstm
 from model import save_args
 from tfmodel import TFModel
 
 
 class LSTM(TFModel):
     _class_log_path_pattern = "lstm/run{}"
+    # layout of the ConvLSTM recurrence; cuDNN convolves natively in channels_first,
+    # but CPU conv kernels only support channels_last
+    _lstm_data_format = "channels_first"
 
     @save_args
     def __init__(self,
@@ -37,27 +40,40 @@ class LSTM(TFModel):
         }
 
     def _build_model(self):
-        self.config = tf.ConfigProto(allow_soft_placement=True)  # log_device_placement=True
+        self.config = self._build_config()
         self.graph = tf.Graph()
         with self.graph.as_default():
             self.step = tf.Variable(0, trainable=False, name="step")
 
             self.images, \
             self.target_labels, \
+            self.predict_images, \
             self.prev_output, \
             self.lstm_initial_state, \
             self.lstm_in_dropout, \
             self.lstm_out_dropout, \
             self.small_conv_dropout = self._build_inputs()
 
-            self.logits = self._build_network(
-                self.images,
-                self.prev_output,
-                self.lstm_initial_state,
-                self.lstm_in_dropout,
-                self.lstm_out_dropout,
-                self.small_conv_dropout)
+            # compile the network with XLA so the elementwise ConvLSTM gate ops fuse into single kernels
+            with tf.contrib.compiler.jit.experimental_jit_scope():
+                self.logits = self._build_network(
+                    self.images,
+                    self.prev_output,
+                    self.lstm_initial_state,
+                    self.lstm_in_dropout,
+                    self.lstm_out_dropout,
+                    self.small_conv_dropout)
             self.pred_labels = tf.greater(self.logits, 0)
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                with tf.contrib.compiler.jit.experimental_jit_scope():
+                    predict_logits = self._build_network(
+                        self.predict_images,
+                        self.prev_output,
+                        self.lstm_initial_state,
+                        self.lstm_in_dropout,
+                        self.lstm_out_dropout,
+                        self.small_conv_dropout)
+                self.predict_labels = tf.greater(predict_logits, 0)
 
             self.loss = self._build_loss(self.logits, self.target_labels, self.pos_weight)
             self.optimizer = self._build_optimizer(self.loss, self.rate, self.epsilon, self.step)
@@ -186,19 +202,32 @@ class LSTM(TFModel):
             lstm_input = tf.concat([large_pool, pool], axis=-1, name="lstm_input")
 
             with tf.name_scope("lstm"):
-                cell = tf.contrib.rnn.DropoutWrapper(
-                    ConvLSTMCell(
-                        input_shape=(self.height, self.width, 32 + 20),
-                        output_channels=self.lstm_kernels,
-                        kernel_shape=(1, 1)),
-                    input_keep_prob=1-lstm_in_dropout,
-                    output_keep_prob=1-lstm_out_dropout)
-
-                lstm, state = tf.contrib.rnn.dynamic_rnn(
+                # dropout is applied outside the cell since its inputs are convolved ahead of the time loop
+                lstm_input = tf.nn.dropout(lstm_input, keep_prob=1-lstm_in_dropout)
+                if self._lstm_data_format == "channels_first":
+                    # [batch, time, h, w, c] -> [batch, time, c, h, w]
+                    lstm_input = tf.transpose(lstm_input, [0, 1, 4, 2, 3])
+                    input_shape = (32 + 20, self.height, self.width)
+                else:
+                    input_shape = (self.height, self.width, 32 + 20)
+                cell = ConvLSTMCell(
+                    input_shape=input_shape,
+                    output_channels=self.lstm_kernels,
+                    kernel_shape=(1, 1),
+                    project_inputs=True,
+                    data_format=self._lstm_data_format,
+                    reuse=tf.get_variable_scope().reuse)
+
+                lstm, state = dynamic_conv_lstm(
                     cell,
                     lstm_input,
                     initial_state=lstm_initial_state,
+                    # swap per-step activations to host memory between the forward and backward passes
+                    swap_memory=True,
                     scope="lstm")
+                if self._lstm_data_format == "channels_first":
+                    lstm = tf.transpose(lstm, [0, 1, 3, 4, 2])
+                lstm = tf.nn.dropout(lstm, keep_prob=1-lstm_out_dropout)
 
             with tf.name_scope("small_conv"):
                 small_conv = tf.layers.conv2d(
@@ -1,4 +1,3 @@
-import random
 import time
 from math import ceil
 from abc import ABCMeta, abstractmethod
@@ -6,11 +5,17 @@ from abc import ABCMeta, abstractmethod
 import numpy as np
 import tensorflow as tf
 from scipy.stats import hmean
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 from model import Model, save_args
-from misc import chunks
 
 class TFModel(Model, metaclass=ABCMeta):
+    # write summaries every this many training steps
+    _summary_interval = 10
+    # device input batches are prefetched to; None on machines without a GPU
+    _prefetch_device = "/gpu:0"
+    _writer = None
+
     @save_args
     def __init__(self,
                  width=640,
@@ -31,16 +36,23 @@ class TFModel(Model, metaclass=ABCMeta):
     def _test_feed_dict(self):
         return {}
 
+    def _build_config(self):
+        config = tf.ConfigProto(allow_soft_placement=True)  # log_device_placement=True
+        config.graph_options.rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+        return config
+
     def _build_model(self):
-        self.config = tf.ConfigProto(allow_soft_placement=True)  # log_device_placement=True
+        self.config = self._build_config()
         self.graph = tf.Graph()
         with self.graph.as_default():
             # with self.graph.device("/gpu:0"):
             self.step = tf.Variable(0, trainable=False, name="step")
-            self.images, self.target_labels = self._build_inputs()
+            self.images, self.target_labels, self.predict_images = self._build_inputs()
 
             self.logits = self._build_network(self.images)
             self.pred_labels = tf.greater(self.logits, 0)
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                self.predict_labels = tf.greater(self._build_network(self.predict_images), 0)
 
             self.loss = self._build_loss(self.logits, self.target_labels, self.pos_weight)
             self.optimizer = self._build_optimizer(self.loss, self.rate, self.epsilon, self.step)
@@ -54,9 +66,40 @@ class TFModel(Model, metaclass=ABCMeta):
 
     def _build_inputs(self):
         with tf.name_scope("input"):
-            images = tf.placeholder(tf.float32, [None, self.height, self.width, self.depth], "images")
-            target_labels = tf.placeholder(tf.bool, [None, self.height, self.width], "target_labels")
-            return images, target_labels
+            self.dataset_images = tf.placeholder(tf.uint8, [None, self.height, self.width, self.depth], "dataset_images")
+            self.dataset_labels = tf.placeholder(tf.bool, [None, self.height, self.width], "dataset_labels")
+            self.dataset_indices = tf.placeholder(tf.int64, [None], "dataset_indices")
+            self.dataset_batch_size = tf.placeholder(tf.int64, [], "dataset_batch_size")
+            self.dataset_shuffle = tf.placeholder_with_default(False, [], "dataset_shuffle")
+            self.dataset_epochs = tf.placeholder_with_default(tf.constant(1, tf.int64), [], "dataset_epochs")
+
+            def prefetch(dataset):
+                dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+                if self._prefetch_device is not None:
+                    # prefetch_to_device must be the last transformation in the pipeline
+                    dataset = dataset.apply(tf.data.experimental.prefetch_to_device(self._prefetch_device))
+                return dataset
+
+            # a shuffle buffer of 1 keeps the order for test()
+            shuffle_buffer = tf.where(self.dataset_shuffle,
+                                      tf.size(self.dataset_indices, out_type=tf.int64),
+                                      tf.constant(1, tf.int64))
+
+            dataset = tf.data.Dataset.from_tensor_slices(self.dataset_indices)
+            dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+            dataset = dataset.repeat(self.dataset_epochs)
+            dataset = dataset.batch(self.dataset_batch_size)
+            dataset = dataset.map(lambda batch: (tf.to_float(tf.gather(self.dataset_images, batch)),
+                                                 tf.gather(self.dataset_labels, batch)))
+            self.iterator = prefetch(dataset).make_initializable_iterator()
+            images, target_labels = self.iterator.get_next("next_batch")
+
+            predict_dataset = tf.data.Dataset.from_tensor_slices(self.dataset_indices)
+            predict_dataset = predict_dataset.batch(self.dataset_batch_size)
+            predict_dataset = predict_dataset.map(lambda batch: tf.to_float(tf.gather(self.dataset_images, batch)))
+            self.predict_iterator = prefetch(predict_dataset).make_initializable_iterator()
+            predict_images = self.predict_iterator.get_next("next_predict_images")
+            return images, target_labels, predict_images
 
     @abstractmethod
     def _build_network(self, images):
@@ -77,7 +120,10 @@ class TFModel(Model, metaclass=ABCMeta):
         """
         with tf.name_scope("loss"):
             # cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=tf.to_int32(labels))
-            cross_entropy = tf.nn.weighted_cross_entropy_with_logits(logits=logits, targets=tf.to_float(labels), pos_weight=pos_weight)
+            targets = tf.cast(labels, logits.dtype)
+            cross_entropy = tf.nn.sigmoid_cross_entropy_with_logits(logits=logits, labels=targets)
+            if pos_weight != 1:
+                cross_entropy *= targets * (pos_weight - 1) + 1
             cross_entropy_mean = tf.reduce_mean(cross_entropy, name='x_entropy_mean')
             tf.summary.scalar('x_entropy_mean', cross_entropy_mean)
             return cross_entropy_mean
@@ -85,7 +131,9 @@ class TFModel(Model, metaclass=ABCMeta):
     def _build_optimizer(self, loss, rate, epsilon, step):
         with tf.name_scope("optimizer"):
             optimizer = tf.train.AdamOptimizer(learning_rate=rate, epsilon=epsilon)
-            return optimizer.minimize(loss, global_step=step, name="optimize")
+            optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer)
+            with tf.contrib.compiler.jit.experimental_jit_scope():
+                return optimizer.minimize(loss, global_step=step, name="optimize")
 
     def _build_evaluator(self, target, predicted):
         target_flat = tf.reshape(target, [-1])
@@ -101,9 +149,37 @@ class TFModel(Model, metaclass=ABCMeta):
     def _initialize_model(self):
         self.session.run(tf.global_variables_initializer())
 
+    def _get_writer(self):
+        if self._writer is None or self._writer.get_logdir() != self.log_path:
+            self.close()
+            self._writer = tf.summary.FileWriter(self.log_path, self.graph)
+        return self._writer
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def _initialize_dataset(self, images, labels, indices, batch_size, epochs=1, shuffle=False):
+        self.session.run(self.iterator.initializer, {
+            self.dataset_images: images,
+            self.dataset_labels: labels,
+            self.dataset_indices: indices,
+            self.dataset_batch_size: batch_size,
+            self.dataset_epochs: epochs,
+            self.dataset_shuffle: shuffle
+        })
+
+    def _initialize_predict_dataset(self, images, indices, batch_size):
+        self.session.run(self.predict_iterator.initializer, {
+            self.dataset_images: images,
+            self.dataset_indices: indices,
+            self.dataset_batch_size: batch_size
+        })
+
     def train(self, images, labels, indices=None, epochs=None, batch_size=None):
         if indices is None:
-            indices = list(range(len(images)))
+            indices = np.arange(len(images))
         else:
             indices = np.r_[tuple(indices)]
 
@@ -113,65 +189,72 @@ class TFModel(Model, metaclass=ABCMeta):
         if batch_size == None:
             batch_size = self.batch_size
 
-        writer = tf.summary.FileWriter(self.log_path, self.graph)
-        num_batches = ceil(len(indices) / self.batch_size)
+        if len(indices) == 0:
+            return
 
-        for epoch in range(1, epochs+1):
-            random.shuffle(indices)
-            batches = chunks(indices, batch_size)
-            start = time.time()
+        writer = self._get_writer()
+        num_batches = ceil(len(indices) * epochs / batch_size)
 
-            for i, frames in enumerate(batches, 1):
-                summary, _ = self.session.run([self.summary, self.optimizer],
-                                              {self.images: images[frames], self.target_labels: labels[frames]})
+        self._initialize_dataset(images, labels, indices, batch_size, epochs=epochs, shuffle=True)
+        epoch = 1
+        start = time.time()
+
+        for i in range(1, num_batches+1):
+            batch_epoch = (i - 1) * batch_size // len(indices) + 1
+            if batch_epoch != epoch:
+                print()
+                epoch = batch_epoch
+                start = time.time()
+
+            if i % self._summary_interval == 0 or i == num_batches:
+                summary, _ = self.session.run([self.summary, self.optimizer])
                 writer.add_summary(summary, tf.train.global_step(self.session, self.step))
-                # if i % 10 == 0 or i == num_batches:
-                print("Epoch {}: batch {} of {} | {:.3f}s".format(
-                    epoch,
-                    i,
-                    num_batches,
-                    time.time() - start), end="\r")
-            print()
-
-        writer.close()
-
-    def predict(self, images, indices=None, batch_size=3):
-        # for some reason batch size 3 runs faster than larger batch sizes
+            else:
+                self.session.run(self.optimizer)
+            print("Epoch {}: batch {} of {} | {:.3f}s".format(
+                epoch,
+                i,
+                num_batches,
+                time.time() - start), end="\r")
+        print()
+
+        writer.flush()
+
+    def predict(self, images, indices=None, batch_size=None):
         if indices is None:
-            indices = range(len(images))
+            indices = np.arange(len(images))
         else:
             indices = np.r_[tuple(indices)]
 
+        if batch_size == None:
+            batch_size = self.batch_size
+
         # images shape: [count, h, w, rgb=3]; use h and w from image
         pred = np.empty((len(indices), images.shape[1], images.shape[2]), dtype=np.bool)
-        batches = chunks(indices, batch_size)
-        conf_mat = np.zeros([2, 2], dtype=np.int)
+        self._initialize_predict_dataset(images, indices, batch_size)
 
-        for i, batch in enumerate(batches):
-            start = i * batch_size
-            pred[start:start+batch_size] = self.session.run(
-                self.pred_labels,
-                {self.images: images[batch]})
+        for start in range(0, len(indices), batch_size):
+            pred[start:start+batch_size] = self.session.run(self.predict_labels)
 
         return pred
 
-    def test(self, images, expected, indices=None, batch_size=3):
-        # for some reason batch size 3 runs faster than larger batch sizes
+    def test(self, images, expected, indices=None, batch_size=None):
         if indices is None:
-            indices = range(len(input))
+            indices = np.arange(len(images))
         else:
             indices = np.r_[tuple(indices)]
 
+        if batch_size == None:
+            batch_size = self.batch_size
+
         # images shape: [count, h, w, rgb=3]; use h and w from image
         pred = np.empty((len(indices), images.shape[1], images.shape[2]), dtype=np.bool)
-        batches = chunks(indices, batch_size)
         conf_mat = np.zeros([2, 2], dtype=np.int)
+        self._initialize_dataset(images, expected, indices, batch_size)
 
-        for i, batch in enumerate(batches):
-            start = i * batch_size
+        for start in range(0, len(indices), batch_size):
             pred[start:start+batch_size], cf = self.session.run(
-                [self.pred_labels, self.confusion_matrix],
-                {self.images: images[batch], self.target_labels: expected[batch]})
+                [self.pred_labels, self.confusion_matrix])
             conf_mat += cf
 
         accuracy = conf_mat.diagonal().sum() / conf_mat.sum()